@@ -31,7 +31,7 @@ def run(filename=None, test=False, start=0, verbose=True):
                 return f.read().splitlines()[start:]
 
     def verify_answer(exp, result, answer):
-        if isinstance(result, list):
+        if isinstance(result, SyntaxTree):
             raise Warning('--- Incomplete evaluation ---')
         elif eq(result, eval(answer)):
             if verbose: print('--- OK! ---')
@@ -130,8 +130,10 @@ def load_mods():
     from eval import calc_eval, LOAD, LINE
     from format import calc_format
     from funcs import eq, SyntaxTree
+    from parse import IncrementalParser
     
     LOAD.run = run
+    io.read.on_edit = IncrementalParser().check
     log.format = calc_format
     
     globals().update(locals())
@@ -29,6 +29,19 @@ broadcast_ops = {
 
 operators = {'BOP': binary_ops, 'LOP': unary_l_ops, 'ROP': unary_r_ops}
 
+def close(x, y): return np.abs(np.subtract(x, y)) < config.tolerance
+def not_close(x, y): return np.abs(np.subtract(x, y)) >= config.tolerance
+
+broadcast_ufuncs = {  # numpy equivalents of the broadcast operators
+    'BOP': {
+        '+': np.add, '-': np.subtract, '*': np.multiply, '/': np.true_divide,
+        './': np.true_divide, '//': np.floor_divide, '%': np.mod, '^': np.power,
+        '<': np.less, '>': np.greater, '<=': np.less_equal, '>=': np.greater_equal,
+        '==': close, '~=': not_close
+    },
+    'LOP': {'-': np.negative}
+}
+
 shortcircuit_ops = ['or', 'if', 'and']  # precedences from low to high
 
 
@@ -39,9 +52,12 @@ def construct_ops(op_dict, type):
         op_dict[op] = obj = Op(type, op, fun, pri)
         if op in broadcast_ops:
             obj.broadcast = True
+            obj.ufunc = broadcast_ufuncs.get(type, {}).get(op)
 
 for op_type, op_dict in operators.items():
     construct_ops(op_dict, op_type)
+
+binary_ops['in'].lazy = binary_ops['(app)'].lazy = True
     
 op_symbols = set.union(*map(set, operators.values()))
 
@@ -69,20 +85,22 @@ builtins = {
     'Real': Real, 'Complex': Complex, 'Fraction': Fraction,
     'Symbol': Symbol, 'Matrix': Matrix, 'Array': Array, 'List': tuple, 
     'String': str, 'Env': Env, 'Range': Range, 'Op': Op, 'type': type,
+    'NumArray': np.ndarray,
     # common functions
     'abs': abs, 'sqrt': sqrt, 'floor': floor, 'ceil': ceiling, 
     # list functions
-    'list': tuple, 'len': len, 'max': max, 'min': min, 'all': all_, 'any': any_,
-    'enum': enumerate, 'zip': zip, 'sort': sorted, 'find': findall,
+    'list': tuple, 'len': len, 'max': max_, 'min': min_, 'all': all_, 'any': any_,
+    'enum': enum, 'zip': zip_, 'sort': sort, 'find': findall, 'first': first, 'records': records,
     'sum': sum_, 'prod': prod, 'Σ': summation, 'Π': product,
     # iter functions
-    'next': next, 'itprod': itprod, 'perms': permutations, 'combs': combinations,
+    'next': next_, 'itprod': itprod, 'perms': permutations, 'combs': combinations,
     # array functions
-    'matrix': Matrix, 'shape': shape, 'depth': depth, 'transp': transpose, 'flatten': flatten,
+    'matrix': Matrix, 'array': array, 'shape': shape, 'depth': depth, 'transp': transpose, 'flatten': flatten,
     # real valued functions
     'exp': exp, 'log': ln, 'ln': ln, 'lg': log10, 'log2': log2,
     # higher order functions
-    'compose': compose, 'reduce': reduce, 'filter': filter, 'map': map, 'deepmap': deepmap,
+    'compose': compose, 'reduce': reduce, 'filter': filter_, 'map': map_, 'deepmap': deepmap,
+    'memo': map_memo,
     # triangular functions
     'sin': sin, 'cos': cos, 'tan': tan, 'asin': asin, 'acos': acos, 'atan': atan, 
     'sinh': sinh, 'cosh': cosh, 'tanh': tanh,
@@ -106,5 +124,12 @@ for name, val in builtins.items():
     if callable(val) and not isinstance(val, type):
         builtins[name] = Builtin(val, name)
 
+for name in ['any', 'all', 'next', 'first']:
+    builtins[name].lazy = True  # consume a lazy list only as far as needed
+
 for name1, name2 in synonym_builtins.items():
     builtins[name1] = builtins[name2]
+
+numeric_builtins = {name: Builtin(f, name) for name, f in numeric_funcs.items()}
+numeric_builtins.update(numeric_consts)
+symbolic_builtins = {name: builtins[name] for name in numeric_builtins}
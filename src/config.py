@@ -2,6 +2,12 @@ tolerance = 1e-12
 precision = 6
 latex = False
 symbolic = 1
+numeric = False  # compute plain numbers without sympy
 debug = 1
 test = 0
-whitespace = r'\s*'  # used in parsing
\ No newline at end of file
+whitespace = r'\s*'  # used in parsing
+memo_size = 1 << 16  # max entries of a memo table; 0 for no limit
+map_memo_size = 1 << 12  # max results memoized by each map; 0 for no limit
+parse_cache_size = 1024  # max lines whose syntax trees are kept
+data_dir = '..'  # relative paths of data files start from here
+parallel = 0  # worker processes of comprehensions, map and filter; off if below 2
@@ -27,13 +27,17 @@ About the application of these rules:
 """
 
 from functools import wraps
-from copy import deepcopy
 import re, json, inspect
+from numbers import Number, Integral
+from collections.abc import Iterator
+import numpy as np
 
 from parse import calc_parse, semantics, Parser
 from builtin import operators, binary_ops, builtins, shortcircuit_ops
-from funcs import Is, iterable, indexable, eq, get_attr, partial
-from sympy import Expr, Symbol, Array, Matrix, Eq, solve
+from builtin import symbolic_builtins, numeric_builtins
+from funcs import Is, iterable, indexable, eq, get_attr, partial, map_array
+from funcs import parallel_enabled, parallel_chunks
+from sympy import Expr, Symbol, Array, Matrix, MatrixBase, Eq, solve
 from objects import *
 from utils.debug import log, trace
 from utils.funcs import *
@@ -43,9 +47,18 @@ import config
 def InitGlobal():
     Global = Env(name='_global_', parent=Builtins)
     Global.ans = []
+    Env.roots[Global.name] = Global
     return Global
 
 Builtins = Env(name='_builtins_', binds=builtins)
+Env.roots[Builtins.name] = Builtins
+
+def set_numeric(on):
+    "Switch the numeric mode, in which plain numbers are computed without sympy."
+    config.numeric = on
+    Builtins.update(numeric_builtins if on else symbolic_builtins)
+    
+set_numeric(config.numeric)
 Global = InitGlobal()
 
 
@@ -61,6 +74,7 @@ def calc_eval(exp, env=None):
         result = None
 
     if result is not None:
+        result = realize(result)
         # record and return the result
         Global.ans.append(result)
         return result
@@ -122,115 +136,133 @@ def LINE(tr):
 LINE.comment = None
 
 
-class ItemStack(list):
-    class substack(list):
-        def __init__(self, parent):
-            self.parent = parent
+# binary ops that can be represented by a space
+get_op = binary_ops['(get)']
+app_op = binary_ops['(app)']
+idx_op = binary_ops['.']
+mul_op = binary_ops['⋅']
 
-        def pop(self, i=-1):
-            x = self.parent.pop(i)
-            y = super().pop(i)
-            assert type(x) == type(y)
-            return x
-        
-        def push(self, x):
-            self.parent.append(x)
-            self.append(x)
-            
-    def __init__(self):
-        self.ops = ItemStack.substack(self)
-        self.vls = ItemStack.substack(self)
-        
 
 def ITEMS(tr):
-    # these are binary ops that can be represented by a space
-    get = binary_ops['(get)']
-    app = binary_ops['(app)']
-    idx = binary_ops['.']
-    mul = binary_ops['⋅']
+    return apply_ops(tr[1:])
 
-    # binary ops that combine in the reverse order
-    backward_bops = [app]
+
+def apply_ops(seq, apply=None):
+    """
+    Combine the values in `seq` by the operators among them. An operator is
+    applied once an operator following it has no higher priority, except
+    that (app) combines in the reverse order; a hidden operator given by a
+    space is resolved when the value after it arrives. The result of an
+    operator is computed by `apply(op, *args)` if given, else `op(*args)`.
+    """
+    stk = []    # pending values and operators; no two values are adjacent
+    kinds = []  # whether each item in stk is an operator
     
-    seq = tr[1:]
-    stk = ItemStack()
+    def push(x, op=False):
+        stk.append(x)
+        kinds.append(op)
+    
+    def pop(op=False):
+        if not kinds or kinds.pop() != op:
+            raise SyntaxError('invalid operator sequence')
+        return stk.pop()
+    
+    def last_op():
+        return stk[-1] if kinds[-1] else stk[-2]
     
     def squeeze():
-        "Applies the previous operator."
-        if stk.ops[-1].type == 'BOP':
-            y, op, x = stk.vls.pop(), stk.ops.pop(), stk.vls.pop()
-            t = op(x, y)
+        "Applies the last operator."
+        op = last_op()
+        if op.type == 'BOP':
+            y, _, x = pop(), pop(True), pop()
+            args = x, y
+        elif op.type == 'LOP':
+            x, _ = pop(), pop(True)
+            args = x,
         else:
-            if stk.ops[-1].type == 'LOP':
-                x, op = stk.vls.pop(), stk.ops.pop()
-            else:
-                op, x = stk.ops.pop(), stk.vls.pop()
-            t = op(x)
-        stk.vls.push(t)
+            _, x = pop(True), pop()
+            args = x,
+        push(apply(op, *args) if apply else op(*args))
         
-    def stk_top():
-        return stk[-1] if stk else None
-    
-    def top_is_op(*ops):
-        return Is.Op(top := stk_top()) and top.type in ops
+    def top_is_op(*types):
+        return kinds and kinds[-1] and stk[-1].type in types
+        
+    def push_op(x):
+        if not top_is_op('LOP', 'BOP'):
+            while True in kinds:
+                op = last_op()
+                if x.priority > op.priority or x == op == app_op:
+                    break
+                squeeze()
+        push(x, True)
+        
+    hidden = False  # whether a hidden op waits for the value after it
     
-    def push(x):
-        if isinstance(x, Op):
-            if x.symbol == '':  # a hidden op given by a space
-                push.unsure = True
-            
-            elif not top_is_op('LOP', 'BOP'):
-                while stk.ops:
-                    op = stk.ops[-1]
-                    if (x.priority > op.priority or
-                        x == op and op in backward_bops):
-                        break
-                    else:
-                        squeeze()
-                    
-            stk.ops.push(x)
-            
-        else:
-            if push.unsure:
-                push.unsure = False
-                    
+    for x in seq:
+        if not isinstance(x, Op):
+            if hidden:
+                hidden = False
                 while top_is_op('LOP'):
-                    stk.vls.push(x)
+                    push(x)
                     squeeze()
-                    x = stk.vls.pop()
-                    
-                assert stk.ops.pop().symbol == ''
-                
+                    x = pop()
+                if pop(True).symbol != '':
+                    raise SyntaxError('invalid operator sequence')
                 while top_is_op('ROP'):
                     squeeze()
-                    
-                x2, x1 = x, stk[-1]
-                
-                if Is.Attr(x2):
-                    push(get)
-                elif callable(x1):
-                    push(app)
-                else:
-                    try:
-                        idx(x1, x2)
-                        push(idx)
-                    except:
-                        push(mul)
-                        
-            stk.vls.push(x)
-
-    push.unsure = False
-    
-    for x in seq:
-        push(x)
-    while stk.ops:
+                push_op(hidden_op(stk[-1], x))
+            push(x)
+        elif x.symbol == '':
+            hidden = True
+            push(x, True)
+        else:
+            push_op(x)
+            
+    while True in kinds:
         squeeze()
-    
-    value = stk.vls.pop()
-    assert not stk
+    value = pop()
+    if stk:
+        raise SyntaxError('invalid operator sequence')
     return value
 
 
+def hidden_op(x1, x2):
+    "Resolve the hidden op between the values `x1` and `x2` by their types."
+    if Is.Attr(x2):
+        return get_op
+    elif callable(x1):
+        return app_op
+    try:
+        op = hidden_ops[type(x1)]
+    except KeyError:
+        op = hidden_ops[type(x1)] = hidden_op_of_type(type(x1))
+    if op is mul_op or op is idx_op and in_range(x2, x1):
+        return op
+    try:  # ambiguous; see if it can be indexed
+        idx_op(x1, x2)
+        return idx_op
+    except:
+        return mul_op
+    
+
+hidden_ops = {}  # type of the value before a hidden op -> the hidden op
+
+def hidden_op_of_type(t):
+    """The hidden op after a value of type `t`; (.) if it depends on the value
+    after it, or None if it cannot be told from the type."""
+    if issubclass(t, Env):  # depends on its val
+        return None
+    elif issubclass(t, (tuple, list, str, Array, MatrixBase, np.ndarray,
+                        LazyList)):  # before Expr: ImmutableMatrix is an Expr
+        return idx_op
+    elif issubclass(t, (Number, Expr)):
+        return mul_op
+
+def in_range(i, seq):
+    "Whether `i` is an integer index of `seq` accepted by (.)."
+    return isinstance(i, Integral) and 0 < abs(i) <= len(seq)
+
+
 def LIST(tr):
     lst = []
     for it in tr[1:]:
@@ -250,7 +282,7 @@ def _conv_lst_if_has_kwds(lst):
     
 
 def tree_tag(tr):
-    if isinstance(tr, list) and tr and type(tr[0]) is str:
+    if isinstance(tr, (list, SyntaxTree)) and tr and type(tr[0]) is str:
         return tr[0]
 
 
@@ -294,8 +326,7 @@ def AND(tr, env):
 
 def KWD(tr, env):
     if is_tree(tr[2]):
-        tr[2] = eval_tree(tr[2], env)
-        return tr
+        return tr.rebuild([tr[1], eval_tree(tr[2], env)])
     else:
         return tr[2]
 
@@ -343,8 +374,7 @@ def QUOTE(tr, env=None):
                 s = format_string(tr[1], env)
                 return Symbol(s)
             else:
-                for i in range(1, len(tr)):
-                    tr[i] = traverse(tr[i])
+                return tr.rebuild(map(traverse, tr[1:]))
         return tr
     return eval_tree(traverse(tr)[1])
     
@@ -368,48 +398,241 @@ def format_string(s, env):
 
 
 def GENER(tr, env):
-    bound_vars = set()
-
-    def generate(exp, constraints):
-        if constraints:
-            constr = constraints[0]
-            tag = tree_tag(constr)
+    _, exp, *constraints = tr
+    local = env.child()
+    init_checks, levels = search_plan(constraints, local)
+    result = compile_tree(exp)
+    
+    def generate():
+        if all(check(local) for check in init_checks):
+            yield from search(levels, local, result)
             
-            if tag == 'DOM':
-                _, var, domain = constr
-                form = FORM(var, local)
-                domain = eval_tree(domain, local, inplace=False)
-                
-                if form.vars & bound_vars:
-                    if form.vars.issubset(bound_vars):
-                        val = eval_tree(form, local)
-                        if val in domain:
-                            yield from generate(exp, constraints[1:])
-                    else:
-                        raise KeyError('form not fully bound in the constraint')
-                else:
-                    bound_vars.update(form.vars)
-                    for val in domain:
-                        bind(form, val, local)
-                        yield from generate(exp, constraints[1:])
+    return generate()
+
+
+def search(levels, env, result, vals=None):
+    """
+    Search the values of the variables in the levels and yield the result
+    for each group of them satisfying the checks. The values of the first
+    level are given by `vals` if it is not None.
+    """
+    if not levels:
+        # realize its lazy lists before the variables are bound again
+        yield realize(result(env))
+        return
+    
+    form, _, _, checks = levels[0]
+    if vals is None:
+        vals = level_values(levels[0], env)
+    for val in vals:
+        bind(form, val, env)
+        if all(check(env) for check in checks):
+            yield from search(levels[1:], env, result)
+
+
+def level_values(level, env):
+    "The values in the domain of the level remaining after its prunes."
+    _, domain, prunes, _ = level
+    vals = domain(env)
+    for k, target in prunes:
+        x = target(env)
+        if k is None:
+            vals = [v for v in vals if eq_op(v, x)]
+        else:
+            vals = [v for v in vals if eq_op(v[k], x)]
+    return vals
+
+
+def search_plan(constraints, env):
+    """
+    Plan the search of a comprehension with the constraints. The domains are
+    searched in their order, each being a level of the search; every other
+    constraint is checked right after the last level binding the variables
+    it uses, instead of after the levels of all the preceding domains, and
+    a constraint 'var == exp' of a variable in a domain's form with `exp`
+    already computable prunes the domain before its values are bound.
+    
+    Returns the checks before any level and a list of the levels, each of
+    which is a tuple (form, domain, prunes, checks).
+    """
+    levels = [[None, None, [], []]]  # the 0th level holds the initial checks
+    level_of = {}  # the level where each variable is bound
+    
+    def level_after(names):  # the level after which the names are all bound
+        return max((level_of[v] for v in names if v in level_of), default=0)
+    
+    def hoist(tree, lv):
+        "Compile the tree to be computed at the level `lv` or earlier if possible."
+        fn = compile_tree(tree)
+        at = level_after(free_vars(tree))
+        if at >= lv - 1: return fn
+        
+        # compute it once each time the level `at` binds its variables
+        # rather than in every entry to the level `lv`
+        cell = []
+        def compute(env):
+            val = fn(env)
+            cell[:] = [tuple(val) if isinstance(val, Iterator) else val]
+            return True
+        levels[at][3].append(compute)
+        return lambda env: cell[0]
+    
+    for constr in constraints:
+        tag = tree_tag(constr)
+        if tag == 'DOM':
+            _, var, domain = constr
+            form = FORM(var, env)
+            if form.vars & level_of.keys():
+                if not form.vars <= level_of.keys():
+                    raise KeyError('form not fully bound in the constraint')
+                # a membership test of the bound form
+                lv = level_after(form.vars | free_vars(domain))
+                levels[lv][3].append(compile_tree(
+                    SyntaxTree(['PHRASE', var, SyntaxTree(['OP', 'in']), domain])))
             else:
-                # actually two cases: BIND and others
-                # if BIND, a new variable will be defined, since
-                # its return value is an Env, which is True in boolean
-                # value, the search will always go deeper;
-                # otherwise, simply check the boolean value of the
-                # constraint and go deeper only when it's True
-                if eval_tree(constr, local, inplace=False):
-                    yield from generate(exp, constraints[1:])
+                levels.append([form, hoist(domain, len(levels)), [], []])
+                level_of.update(dict.fromkeys(form.vars, len(levels) - 1))
+        elif tag == 'BIND':
+            # a new variable is defined in place; since its value is an Env,
+            # which is True in boolean value, the search always goes deeper
+            levels[-1][3].append(compile_tree(constr))
+            level_of.update(dict.fromkeys(free_vars(constr[1]), len(levels) - 1))
         else:
-            yield eval_tree(exp, local, inplace=False)
+            lv = level_after(free_vars(constr))
+            level = levels[lv]
+            if lv and (prune := equality_prune(constr, level[0], level_after)):
+                k, exp = prune
+                level[2].append((k, hoist(exp, lv)))
+            else:
+                level[3].append(compile_tree(constr))
             
-    _, exp, *constraints = tr
-    local = env.child()
-    return generate(exp, constraints)
+    checks = levels[0][3]
+    return checks, [tuple(lv) for lv in levels[1:]]
+
+
+def equality_prune(constr, form, level_after):
+    """
+    If `constr` is 'var == exp' or 'exp == var' where `var` is a variable of
+    `form` and `exp` is computable before `form` is bound, return (k, exp)
+    where k is the index of `var` in `form` (None if `form` is `var` itself);
+    otherwise return None.
+    """
+    if tree_tag(constr) != 'PHRASE': return
+    items = list(constr[1:])
+    if items.count(eq_tree) != 1: return
+    
+    i = items.index(eq_tree)
+    for side, other in [(items[:i], items[i+1:]), (items[i+1:], items[:i])]:
+        if len(side) == 1 and tree_tag(side[0]) == 'NAME':
+            break
+    else: return
+    
+    var = side[0][1]
+    if tree_tag(form) == 'NAME' and form[1] == var:
+        k = None
+    elif tree_tag(form) == 'LIST' and var in form.vars and \
+        all(tree_tag(t) == 'NAME' for t in form[1:]):
+        k = [t[1] for t in form[1:]].index(var)
+    else: return
+    
+    if not other or not all(binds_tighter(t) for t in other): return
+    exp = SyntaxTree(['PHRASE', *other]) if len(other) > 1 else other[0]
+    if level_after(free_vars(exp)) >= level_after([var]): return
+    return k, exp
+
+
+eq_tree = SyntaxTree(['OP', '=='])
+eq_op = binary_ops['==']
+
+def binds_tighter(t):
+    "Whether `t` is not an operator or one binding tighter than '=='."
+    if tree_tag(t) != 'OP': return True
+    ops = [op[t[1]] for op in operators.values() if t[1] in op]
+    return all(isinstance(op, Op) and op.priority > eq_op.priority for op in ops)
+
+
+def free_vars(tr):
+    """
+    The set of the names occurring free in the syntax tree, that is, not
+    bound by a map or a comprehension in it. It may contain other names
+    when it is uncertain whether they are bound.
+    """
+    tag = tree_tag(tr)
+    if tag == 'NAME':
+        return {tr[1]}
+    elif not is_tree(tr):
+        return set()
+    elif tag == 'MAP':
+        _, form, body = tr
+        pars, free = form_names(form)
+        return free | (free_vars(body) - pars)
+    elif tag in ('GENER', 'GENLS'):
+        _, exp, *constraints = tr
+        bound, free = set(), set()
+        for constr in constraints:
+            if tree_tag(constr) == 'DOM':
+                _, var, domain = constr
+                pars, default_free = form_names(var)
+                free |= (default_free | free_vars(domain)) - bound
+                bound |= pars
+            else:
+                free |= free_vars(constr) - bound
+                if tree_tag(constr) == 'BIND':
+                    bound |= free_vars(constr[1])
+        return free | (free_vars(exp) - bound)
+    else:
+        return set().union(*map(free_vars, tr[1:]))
+
+def form_names(form):
+    "The variables of the form and the free names in the rest of it."
+    tag = tree_tag(form)
+    if tag == 'NAME':
+        return {form[1]}, set()
+    elif tag in ('LIST', 'FORM'):
+        pars, free = set(), set()
+        for t in form[1:]:
+            p, f = form_names(t)
+            pars |= p; free |= f
+        return pars, free
+    elif tag == 'KWD' and tree_tag(form[1]) == 'NAME':
+        return {form[1][1]}, free_vars(form[2])
+    else:
+        return set(), free_vars(form)
+
 
 def GENLS(tr, env):
-    return tuple(GENER(tr, env))
+    if parallel_enabled():
+        items = parallel_search(tr, env)
+        if not any(map(has_closure, items)):
+            return items
+    return LazyList(GENER(tr, env))
+
+def parallel_search(tr, env):
+    """Compute the comprehension with its first domain split among the workers.
+    A map or an environment in the items refers to a copy of the local env of
+    the comprehension made by its worker, not to the env itself."""
+    _, exp, *constraints = tr
+    local = env.child()
+    init_checks, levels = search_plan(constraints, local)
+    result = compile_tree(exp)
+    
+    if not all(check(local) for check in init_checks):
+        return ()
+    elif not levels:
+        return (realize(result(local)),)
+    
+    def search_chunk(vals):
+        return list(search(levels, local, result, vals))
+    return tuple(parallel_chunks(search_chunk, level_values(levels[0], local)))
+
+def has_closure(val):
+    "Whether the value holds a map or an environment."
+    if isinstance(val, (Map, Env)):
+        return True
+    elif type(val) is tuple:
+        return any(map(has_closure, val))
+    else:
+        return False
 
 
 def ENV(tr, env):
@@ -419,7 +642,7 @@ def ENV(tr, env):
 
 
 def BIND(tr, env):
-    tr.pop(0)  # remove tag
+    tr = list(tr[1:])  # remove tag
     
     if tree_tag(tr[0]) == 'NS':
         env = eval_tree(tr[0][1], env)
@@ -436,7 +659,7 @@ def BIND(tr, env):
     form, exp = tr
         
     if len(form) > 2:  # defining a map
-        exp = ['MAP', form[2], exp]
+        exp = SyntaxTree(['MAP', form[2], exp])
 
     form = form[1]
     val = eval_tree(exp, env)
@@ -474,11 +697,16 @@ def bind(form, value, env: Env, overwrite=True, retval=False):
         if isinstance(val, Env):
             if val.val is not None and env is not Global:
                 val = val.val
+        elif isinstance(val, LazyList):  # take its items at the binding
+            val = val.realize()
                 
         if isinstance(val, Map):
             if val.__name__ is None:
                 val.__name__ = name
                 val.env = env
+                if val.check_local([name]):  # it may call itself
+                    val._self_name = name
+                    val.set_memo(True)
         elif isinstance(val, Env):
             if env is not Global:
                 val = env.child(name=name, binds=val)
@@ -537,7 +765,7 @@ def bind(form, value, env: Env, overwrite=True, retval=False):
         else:
             raise KeyError("Multiple bindings of '%s'" % name)
 
-    if retval: return eval_tree(form, env, inplace=False)
+    if retval: return eval_tree(form, env)
     # return Env(val=eval_tree(form, env), binds=binds)
 
 
@@ -586,6 +814,7 @@ def FORM(tr, env, _nested=False):
             
     if not _nested and tree_tag(tr) != 'FORM':
         tr = ['FORM', tr]
+    tr = list(tr)  # its items are replaced below
         
     varlist = list(form_vars(tr))
     vars = set(varlist)
@@ -608,21 +837,9 @@ def field_attr(tr, env):
 # macro rules
 
 def PHRASE(tr):
-    def convert_seq(seq):
-        "Converts the phrase into a tree based on its shortcircuit operations."
-        for op in shortcircuit_ops:
-            opt = ['OP', op]
-            if opt in seq:
-                i = seq.index(opt)
-                lt = convert_seq(seq[:i])
-                rt = convert_seq(seq[i+1:])
-                return [op.upper(), lt, rt]
-            
-        seq = parse_op(seq)
-        if is_tree(seq): seq = [seq]
-        return ['ITEMS'] + seq
-    
     def match_unknowns():
+        nonlocal tr
+        tr = list(tr)  # the unknowns are replaced below
         unknowns = set()
         for i, t in enumerate(tr):
             if tree_tag(t) == 'UNKNOWN':
@@ -649,8 +866,62 @@ def PHRASE(tr):
     
     if unknowns:
         return convert_unknown()
+    
+    seq = tr[1:]
+    shape = phrase_shape(seq)
+    if shape is None:
+        return convert_seq(seq)
     else:
-        return convert_seq(tr[1:])
+        return fill_phrase(phrase_template(shape), seq)
+
+
+def convert_seq(seq):
+    "Converts the phrase into a tree based on its shortcircuit operations."
+    for op in shortcircuit_ops:
+        opt = ('OP', op)
+        if opt in seq:
+            i = seq.index(opt)
+            lt = convert_seq(seq[:i])
+            rt = convert_seq(seq[i+1:])
+            return [op.upper(), lt, rt]
+        
+    seq = parse_op(seq)
+    if is_tree(seq): seq = [seq]
+    return ['ITEMS'] + seq
+
+
+def phrase_shape(seq):
+    """The symbols of the operators in the phrase, with None for its other
+    items, which is all its conversion depends on; None if an item has a tag
+    that parse_op would take for its own."""
+    shape = []
+    for t in seq:
+        tag = tree_tag(t)
+        if tag == 'OP':
+            shape.append(t[1])
+        elif tag in semantics or tag in OpParser.tests:
+            return None
+        else:
+            shape.append(None)
+    return tuple(shape)
+
+
+@memo
+def phrase_template(shape):
+    "Convert a phrase of the shape whose items are HOLEs holding their indices."
+    seq = [SyntaxTree(['HOLE', i] if s is None else ['OP', s])
+           for i, s in enumerate(shape)]
+    return convert_seq(seq)
+
+
+def fill_phrase(template, seq):
+    "Put the items of the phrase into the HOLEs of its template."
+    if type(template) is list:
+        return [fill_phrase(t, seq) for t in template]
+    elif tree_tag(template) == 'HOLE':
+        return seq[template[1]]
+    else:
+        return template
     
 
 def UNKNOWN(tr):
@@ -669,16 +940,16 @@ class OpParser(Parser):
     def op_test(self, op, tr):
         return tr.tag == 'OP' and tr[1] in operators[op]
     
-    def parse_atom(self, _tag, tag, phrase):
+    def parse_atom(self, _tag, tag, pos):
         if tag == '':
-            return binary_ops[''], phrase
+            return binary_ops[''], pos
         elif tag in self.tests:
-            tr = phrase[0]
+            tr = self.input[pos]
             if self.tests[tag](tr):
                 if tr.tag == 'OP' and \
                     (op := operators[tag].get(tr[1], 0)):
                         tr = op
-                return tr, phrase[1:]
+                return tr, pos + 1
             else:
                 return self.failed
         else:
@@ -705,7 +976,7 @@ def parse_op(seq):
             l.extend(arg) if type(arg) is list else l.append(arg)
         return l
 
-    tree, rem = op_parser.parse_tag('SEQ', seq)
+    tree, rem = op_parser.parse('SEQ', seq)
     if rem or not tree: raise ValueError
     return flatten(tree)
 
@@ -722,7 +993,7 @@ def DEL(tr, env=None):
 def DIR(tr):
     if tr[-1] == '*':
         items = 'all_items'
-        tr.pop()
+        tr = tr[:-1]
     else:
         items = 'items'
 
@@ -774,6 +1045,11 @@ def IMPORT(tr):
                 val = Function(val)
             Global[name] = val
 
+def MMAP(tr):
+    name, path, *opts = tr[1:]
+    opts = dict(opt[1:].partition('=')[::2] for opt in opts)
+    Global[name] = map_array(path, **opts)
+
 def CONF(tr):
     conf = tr[1]
     if conf in ('prec', 'precision'):
@@ -786,6 +1062,11 @@ def CONF(tr):
             return config.tolerance
         else:
             config.tolerance = float(tr[2])
+    elif conf == 'numeric':
+        if len(tr) == 2:
+            return config.numeric
+        else:
+            set_numeric(bool(tr[2]) and tr[2] != 'off')
     elif hasattr(config, conf):
         if len(tr) == 2:
             return getattr(config, conf)
@@ -812,11 +1093,9 @@ def PYTHON(tr): interact()
 #     return wrapped
 
 # @hold_tree
-def eval_tree(tree: SyntaxTree, env=None, inplace=True):
+def eval_tree(tree: SyntaxTree, env=None):
     if not is_tree(tree):
         return tree
-    if not inplace:
-        tree = deepcopy(tree)
         
     tag = tree.tag
     
@@ -827,11 +1106,13 @@ def eval_tree(tree: SyntaxTree, env=None, inplace=True):
     # simplify subtrees not containing unbound names
     if tag not in eval_rules:
         partial_flag = 0
-        for i, t in enumerate(tree):
-            if i == 0: continue
-            tree[i] = eval_tree(t, env)
-            if is_tree(tree[i]) and tag not in delayed_rules:
+        items = []
+        for t in tree[1:]:
+            t = eval_tree(t, env)
+            if is_tree(t) and (env is None or tag not in delayed_rules):
                 partial_flag = 1
+            items.append(t)
+        tree = tree.rebuild(items)
         if partial_flag:
             return tree
         
@@ -846,16 +1127,113 @@ def eval_tree(tree: SyntaxTree, env=None, inplace=True):
         # raise TypeError('unknown syntax tree type')
 
 
+# compilation of map bodies
+
+def compile_tree(tree):
+    """
+    Compile the tree into a function of an env which evaluates the tree in
+    it like `eval_tree`. The macros are expanded and the precedence of the
+    operators is resolved once here rather than in each evaluation.
+    """
+    if not is_tree(tree):
+        return lambda env: tree
+    
+    tag = tree.tag
+    
+    if tag in macro_rules:
+        try:
+            tree = SyntaxTree(macro_rules[tag](tree))
+        except Exception:  # raise the error when it is evaluated
+            return partial(eval_tree, tree)
+        return compile_tree(tree)
+    elif tag in compile_rules:
+        return compile_rules[tag](tree)
+    elif tag in eval_rules:
+        return partial(eval_tree, tree)
+    
+    rule = subs_rules.get(tag) or exec_rules.get(tag)
+    delayed = tag in delayed_rules
+    items = [compile_tree(t) for t in tree[1:]]
+    
+    def run(env):
+        tr = tree.rebuild([f(env) for f in items])
+        if not delayed and any(map(is_tree, tr)):
+            return tr
+        return rule(tr) if rule else tr
+    return run
+
+
+def compile_items(tree):
+    items = [compile_tree(t) for t in tree[1:]]
+    apply = resolve_items(tree[1:])
+    operands = [i for i, t in enumerate(tree[1:]) if not isinstance(t, Op)]
+    
+    def run(env):
+        vals = [f(env) for f in items]
+        if any(map(is_tree, vals)):
+            return tree.rebuild(vals)
+        elif apply is None or any(isinstance(vals[i], Op) for i in operands):
+            return ITEMS(tree.rebuild(vals))
+        else:
+            return apply(vals)
+    return run
+
+
+def resolve_items(seq):
+    """
+    Return a function that combines the values of the items in `seq` by its
+    operators like ITEMS, or None if `seq` has a hidden operator, whose
+    meaning depends on the values around it.
+    """
+    if any(isinstance(x, Op) and x.symbol == '' for x in seq):
+        return None
+    
+    def apply(op, *args):
+        if len(args) == 2:
+            x, y = args
+            return lambda vals: op(x(vals), y(vals))
+        else:
+            x, = args
+            return lambda vals: op(x(vals))
+    
+    items = [x if isinstance(x, Op) else (lambda vals, i=i: vals[i])
+             for i, x in enumerate(seq)]
+    try:
+        return apply_ops(items, apply)
+    except SyntaxError:
+        return None  # leave the error to ITEMS
+
+
+def compile_shortcircuit(tree):
+    a, b = map(compile_tree, tree[1:])
+    if tree.tag == 'OR':
+        return lambda env: a(env) or b(env)
+    elif tree.tag == 'AND':
+        return lambda env: a(env) and b(env)
+    else:  # IF
+        return lambda env: b(env) and a(env)
+
+
+compile_rules = {
+    'NAME': lambda tree: partial(NAME, tree),
+    'ITEMS': compile_items,
+    'OR': compile_shortcircuit,
+    'AND': compile_shortcircuit,
+    'IF': compile_shortcircuit
+}
+
+
 NAME.force_symbol = False
 # assign LOAD.run in 'calc.py'
 LOAD.run  = NotImplemented
 Map.bind = bind
 Map.eval  = eval_tree
+Map.compile = compile_tree
 
 
 exec_rules = {name: eval(name) for name in [
-    'DIR',      'LOAD',     'IMPORT',   'CONF',
-    'EXIT',     'PYTHON'
+    'DIR',      'LOAD',     'IMPORT',   'MMAP',
+    'CONF',     'EXIT',     'PYTHON'
 ]}
 
 macro_rules = {name: eval(name) for name in [
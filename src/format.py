@@ -7,7 +7,7 @@ from objects import *
 from parse import deparse
 from utils.debug import log
 from utils.funcs import indexable
-import config, objects
+import config, objects, math
 
 
 sympy_matrix_box = '⎡⎤⎢⎥⎣⎦'
@@ -44,7 +44,7 @@ class Formatter:
         def supscript(n):
             return '⁻' + pos_supscript(-n) if n < 0 else pos_supscript(n)
         def positive_case(x):
-            e = floor(log(x)/log(10))
+            e = math.floor(math.log10(x))
             b = self.format_float(x/10**e)
             return f"{b}×10{supscript(e)}"
         if x == 0:
@@ -97,7 +97,7 @@ class Formatter:
         
     def format_number(self, val):
         mag = abs(val)
-        if type(val) is complex:
+        if isinstance(val, complex):
             re = self.format_float(val.real)
             im = self.format_float(val.imag)
             return f"{re} {'-' if im<0 else '+'} {abs(im)}ⅈ"
@@ -5,10 +5,14 @@ from functools import reduce, wraps, partial
 from itertools import product as itprod, permutations, combinations
 from fractions import Fraction
 from copy import deepcopy
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+import math, cmath, os, itertools
+import multiprocessing as mp
 import numpy as np
 from sympy import (
     S, E, pi, nan, oo,
-    Symbol, Array, Matrix, Eq, Integer, Float, Expr,
+    Symbol, Array, Matrix, Eq, Integer, Float, Expr, Number as SympyNumber,
     floor, ceiling, sqrt, log as ln, exp, gamma,
     factorial, expand, factor, solve, summation, product,
     gcd, factorint, binomial,
@@ -47,21 +51,34 @@ class IsInstance:
             self.ns = globals()
         else:
             self.ns = ns
+        self.preds = {}  # resolved names -> predicates or nested IsInstances
             
-    def __getattribute__(self, type):
-        ns = super().__getattribute__('ns')
-        try: type = eval(type, ns)
+    def __getattr__(self, name):
+        if name in ('ns', 'preds'):  # not initialized yet
+            raise AttributeError(name)
+        try:
+            return self.preds[name]
+        except KeyError:
+            pass
+        
+        try: type = eval(name, self.ns)
         except NameError: return
         
         if hasattr(type, '__package__'):
-            return IsInstance(type.__dict__)
+            pred = IsInstance(type.__dict__)
         else:
-            return lambda *args: all(IsInstance.q(arg, type)
-                                     for arg in args)
+            pred = self(type)
+        self.preds[name] = pred
+        return pred
 
     def __call__(self, *types):
-        return lambda *args: all(IsInstance.q(arg, types)
-                                 for arg in args)
+        q = IsInstance.q
+        def pred(*args):
+            for arg in args:
+                if not q(arg, types):
+                    return False
+            return True
+        return pred
 
 Is = IsInstance()
 
@@ -76,16 +93,25 @@ def is_env(val):  # special case
 
 
 def call(fn, val):
+    if not isinstance(fn, Function):
+        val = realize(val)
     return fn(val)
 
 
-def convert_input(arg):
-    if Is(list, tuple)(arg):
-        return tuple(map(convert_input, arg))
+plain_types = {int, float, complex, str}
+
+def convert_input(arg, lazy=False):
+    "Convert the argument of a function; keep its lazy lists if `lazy`."
+    if type(arg) is tuple and all(type(a) in plain_types for a in arg):
+        return arg  # nothing to convert
+    elif isinstance(arg, LazyList):
+        return arg if lazy else convert_input(arg.realize())
+    elif Is(list, tuple)(arg):
+        return tuple(convert_input(a, lazy) for a in arg)
     elif Is.Env(arg) and arg.val is not None:
         return arg.val
     elif Is.dict(arg):
-        return {k: convert_input(v) for k, v in arg.items()}
+        return {k: convert_input(v, lazy) for k, v in arg.items()}
     else:
         return arg
     
@@ -107,7 +133,17 @@ def convert_output(val):
         else:
             return convert_num(complex(val))
 
-    if is_tree(val):
+    if type(val) in (int, float):
+        return val
+    elif isinstance(val, np.generic):  # an element of an ndarray
+        return convert_output(val.item())
+    elif type(val) is Fraction:
+        return int(val) if val.denominator == 1 else float(val)
+    elif type(val) is complex:
+        return convert_num(val)
+    elif isinstance(val, np.ndarray):
+        return array_value(val)
+    elif is_tree(val) or isinstance(val, (Range, Iterator, LazyList, Stream)):
         return val
     elif type(val) is bool:
         return 1 if val else 0
@@ -117,9 +153,12 @@ def convert_output(val):
         return Env(binds=val)
     elif callable(val) and not Is.Function(val):
         return Function(val)
+    elif isinstance(val, SympyNumber):  # no need to simplify
+        return convert_num(val)
     else:
-        try: val = simplify(val)
-        except: pass
+        if config.symbolic:
+            try: val = simplify(val)
+            except: pass
         try: return convert_num(val)
         except: return val
         
@@ -128,6 +167,51 @@ Function.proc_in = convert_input
 Function.proc_out = convert_output
 
 
+native_nums = (int, float, Fraction)
+
+def numeric(sym_fn, real_fn, complex_fn=None):
+    """
+    Make a function computed by `sym_fn` from sympy, except that if the
+    numeric mode is on and its args are all plain numbers, it is computed
+    by `real_fn`, or by `complex_fn` if an arg is complex or `real_fn` fails.
+    """
+    def f(*args):
+        if config.numeric:
+            types = set(map(type, args))
+            if types.issubset(native_nums):
+                try: return real_fn(*args)
+                except (TypeError, ValueError, OverflowError): pass
+            if complex_fn and types.issubset(native_nums + (complex,)):
+                try: return complex_fn(*args)
+                except (TypeError, ValueError, OverflowError): pass
+        return sym_fn(*args)
+    f.__name__ = sym_fn.__name__
+    f.__doc__ = sym_fn.__doc__
+    return f
+
+numeric_funcs = {  # builtins replaced in the numeric mode
+    'sqrt': numeric(sqrt, math.sqrt, cmath.sqrt),
+    'floor': numeric(floor, math.floor),
+    'ceil': numeric(ceiling, math.ceil),
+    'exp': numeric(exp, math.exp, cmath.exp),
+    'log': numeric(ln, math.log, cmath.log),
+    'ln': numeric(ln, math.log, cmath.log),
+    'sin': numeric(sin, math.sin, cmath.sin),
+    'cos': numeric(cos, math.cos, cmath.cos),
+    'tan': numeric(tan, math.tan, cmath.tan),
+    'asin': numeric(asin, math.asin, cmath.asin),
+    'acos': numeric(acos, math.acos, cmath.acos),
+    'atan': numeric(atan, math.atan, cmath.atan),
+    'sinh': numeric(sinh, math.sinh, cmath.sinh),
+    'cosh': numeric(cosh, math.cosh, cmath.cosh),
+    'tanh': numeric(tanh, math.tanh, cmath.tanh),
+    'factorial': numeric(factorial, math.factorial),
+}
+
+numeric_consts = {'euler': math.e, 'ℯ': math.e, 'pi': math.pi, 'π': math.pi,
+                  'φ': (1 + math.sqrt(5)) / 2, '∞': math.inf}
+
+
 def likematrix(value):
     if isinstance(value, Matrix): return True
     return (depth(value, max) == depth(value, min) == 2 and
@@ -152,6 +236,7 @@ def pow(x, y):
         return x ** y
     
 def in_(x, y):
+    x = realize(x)
     if isinstance(y, type):
         return isinstance(x, y)
     else:
@@ -219,6 +304,13 @@ def not_(x):
     return 0 if x else 1
 
 def eq(x, y):
+    if any_(Is.np.ndarray, [x, y]):  # compare them as lists
+        x, y = np.asarray(x), np.asarray(y)
+        try:
+            return x.shape == y.shape and \
+                bool(np.all(abs(x - y) < config.tolerance))
+        except TypeError:
+            x, y = convert_output(x.tolist()), convert_output(y.tolist())
     try:
         return abs(x - y) < config.tolerance
     except:
@@ -235,14 +327,231 @@ def exclaim(x):
         else:
             return broadcast(x)
     else:
-        return factorial(x)
+        return numeric_funcs['factorial'](x)
+
+def log2(x): return numeric_funcs['log'](x, 2)
+def log10(x): return numeric_funcs['log'](x, 10)
+def sum_(*x):
+    if len(x) == 1 and isinstance(x[0], np.ndarray):
+        return x[0].sum(axis=0)
+    elif len(x) == 1 and isinstance(x[0], (Iterator, Stream)):
+        x = x[0]
+    return reduce(add, x, 0)
+
+def lazy_items(name, gen, *args):
+    """The items generated by `gen(*args)`: a stream that applies `gen` again
+    each time it is iterated if some of the args is a stream, so that the
+    items are not kept in memory; otherwise a lazy list."""
+    if any(isinstance(a, Stream) for a in args):
+        return Stream(gen, *args, name='%s[%s]' % (name, ', '.join(map(repr, args))))
+    return LazyList(gen(*args))
+
+def map_(f, *lists):
+    if parallel_enabled() and not any(isinstance(l, Stream) for l in lists):
+        return tuple(parallel_chunks(lambda c: [realize(f(*a)) for a in c],
+                                     zip(*lists)))
+    return lazy_items('map', map, f, *lists)
+
+def filter_(f, lst):
+    if parallel_enabled() and not isinstance(lst, Stream):
+        return tuple(parallel_chunks(lambda c: [x for x in c if f(x)], lst))
+    return lazy_items('filter', filter, f, lst)
+
+def zip_(*lists): return lazy_items('zip', zip, *lists)
+def enum(lst): return lazy_items('enum', enumerate, lst)
+
+def prod(*x):
+    if len(x) == 1 and is_vector(x[0]):
+        return x[0].prod()
+    return reduce(dot, x, 1)
+
+def max_(*x):
+    if len(x) == 1 and is_vector(x[0]):
+        return x[0].max()
+    return max(*x)
+
+def min_(*x):
+    if len(x) == 1 and is_vector(x[0]):
+        return x[0].min()
+    return min(*x)
+
+def sort(x):
+    return np.sort(x) if is_vector(x) else sorted(x)
+
+def is_vector(x):
+    return isinstance(x, np.ndarray) and x.ndim == 1
+
+def deg(x): return x / 180 * (math.pi if config.numeric else pi)
+def polar(r, t):
+    cos, sin = numeric_funcs['cos'], numeric_funcs['sin']
+    return complex(r*cos(t), r*sin(t))
+
+
+def array_value(arr):
+    """
+    The value of the ndarray `arr`: itself if its elements are numbers, in
+    which case it is the array value of a list; otherwise a nested tuple.
+    """
+    kind = arr.dtype.kind
+    if kind in 'iufc':
+        return arr
+    elif kind == 'b':
+        return arr.astype(int)
+    else:
+        return convert_output(arr.tolist())
+
+def array(lst):
+    "Convert a list of numbers into an array."
+    return array_value(np.asarray(lst))
+
+
+def map_memo(f, on=None):
+    """
+    Turn on or off the memo of the map `f` if `on` is given; otherwise return
+    the statistics of the memo, or None if it is off.
+    """
+    if not isinstance(f, Map):
+        raise TypeError('only a map has a memo')
+    if on is None:
+        return f.memo_stats()
+    f.set_memo(on)
+
+
+def parallel_enabled():
+    "Whether the parallel mode is on and supported by the platform."
+    return config.parallel > 1 and 'fork' in mp.get_all_start_methods()
+
+def parallel_chunks(fn, items):
+    """
+    Split the items into chunks and compute `fn(chunk)`, which is a list, for
+    each of them in config.parallel worker processes; return the results
+    joined in the order of the chunks. The workers are forked, so that `fn`
+    and the environments it uses need not be pickled; only the results are.
+    """
+    global parallel_task
+    items = list(items)
+    n = int(config.parallel)
+    size = max(1, -(-len(items) // (4 * n)))
+    chunks = [items[i:i+size] for i in range(0, len(items), size)]
+    if len(chunks) < 2:
+        return [y for c in chunks for y in fn(c)]
+    
+    parallel_task = lambda i: fn(chunks[i])
+    try:
+        with ProcessPoolExecutor(n, mp_context=mp.get_context('fork')) as pool:
+            results = list(pool.map(run_parallel_task, range(len(chunks))))
+    finally:
+        parallel_task = None
+    return [y for r in results for y in r]
+
+parallel_task = None  # the task of the forked workers
 
-def log2(x): return ln(x, 2)
-def log10(x): return ln(x, 10)
-def sum_(*x): return reduce(add, x, 0)
-def prod(*x): return reduce(dot, x, 1)
-def deg(x): return x / 180 * pi
-def polar(r, t): return complex(r*cos(t), r*sin(t))
+def run_parallel_task(i):
+    config.parallel = 0  # no nested pools in a worker
+    return parallel_task(i)
+
+
+def data_path(path):
+    "The path of a data file; a relative one starts from config.data_dir."
+    return os.path.join(config.data_dir, os.path.expanduser(path))
+
+def records(path, sep=None, skip=0):
+    """
+    The records of the text file at `path`, read lazily each time they are
+    iterated: one per nonblank line after the first `skip` lines. A line is
+    split into fields by `sep` (',' for a '.csv' file, else not split), and
+    the numeric fields are converted to numbers; a record of one field is
+    the field itself.
+    """
+    path = data_path(path)
+    if sep is None:
+        sep = ',' if path.lower().endswith('.csv') else ''
+    return Stream(read_records, path, sep, skip, name='records["%s"]' % path)
+
+def read_records(path, sep, skip):
+    "Generate the records of the file at `path`; see `records`."
+    with open(path, encoding='utf8') as f:
+        for line in itertools.islice(f, skip, None):
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            fields = line.split(sep) if sep else [line]
+            rec = tuple(map(parse_field, fields))
+            yield rec if len(rec) > 1 else rec[0]
+
+def parse_field(s):
+    "Convert a field of a record to a number if it is one."
+    s = s.strip()
+    for num in (int, float):
+        try: return num(s)
+        except ValueError: pass
+    return s
+
+def map_array(path, dtype=None, width=None, cols=None, skip=0):
+    """
+    Open the data file at `path` as a read-only memory-mapped array.
+    A '.npy' file is mapped as it is. A '.csv' file has its columns `cols`
+    (all by default) copied to a '.npy' file next to it, which is mapped.
+    Any other file is mapped as raw binary of `dtype` (float64 by default),
+    in rows of `width` items if it is given.
+    """
+    path = data_path(path)
+    dtype = np.dtype(dtype or 'f8')
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return np.load(path, mmap_mode='r')
+    elif ext == '.csv':
+        if cols is not None:
+            cols = [int(c) - 1 for c in str(cols).split(',')]
+        skip = int(skip)
+        # the copy depends on every option that changes its content
+        suffix = ''.join(['' if cols is None else
+                          '.' + '_'.join(str(c+1) for c in cols),
+                          '.skip%d' % skip if skip else '',
+                          '' if dtype == np.float64 else '.' + dtype.name])
+        npy = '%s%s.npy' % (path, suffix)
+        if not os.path.exists(npy) or \
+                os.path.getmtime(npy) < os.path.getmtime(path):
+            csv_to_npy(path, npy, dtype, cols, skip)
+        return np.load(npy, mmap_mode='r')
+    else:
+        arr = np.memmap(path, dtype, mode='r')
+        return arr.reshape(-1, int(width)) if width else arr
+
+def csv_to_npy(path, npy, dtype, cols=None, skip=0, chunk=1 << 16):
+    """Copy the columns `cols` of the csv file at `path` to `npy` by chunks.
+    The copy is written to a temporary file, which replaces `npy` only when
+    it is complete."""
+    def rows(f):
+        return (line for line in itertools.islice(f, skip, None)
+                if line.strip())
+    
+    with open(path) as f:
+        lines = rows(f)
+        first = next(lines, None)
+        if first is None:
+            raise ValueError(f'no data in "{path}"')
+        ncols = len(cols) if cols else len(first.split(','))
+        nrows = 1 + sum(1 for _ in lines)
+        
+    shape = (nrows,) if ncols == 1 else (nrows, ncols)
+    tmp, arr = npy + '.tmp', None
+    try:
+        arr = np.lib.format.open_memmap(tmp, 'w+', dtype, shape)
+        with open(path) as f:
+            lines, i = rows(f), 0
+            while block := list(itertools.islice(lines, chunk)):
+                data = np.loadtxt(block, dtype, delimiter=',', usecols=cols,
+                                  ndmin=2)
+                arr[i:i+len(block)] = data.reshape(len(block), *shape[1:])
+                i += len(block)
+        arr.flush()
+        del arr
+        os.replace(tmp, npy)
+    except BaseException:
+        arr = None  # close the map before removing its file
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
 
 
 class FromNumpy:
@@ -255,12 +564,12 @@ class FromNumpy:
         @wraps(f)
         def wrapped(*args, **kwds):
             ret = f(*args, **kwds)
-            if any_(Is.np.ndarray, args):
+            if not isinstance(ret, np.ndarray):
                 return ret
-            elif isinstance(ret, np.ndarray):
+            elif any_(Is.np.ndarray, args):
+                return array_value(ret)
+            else:  # lists stay lists
                 return ret.tolist()
-            else:
-                return ret
         return wrapped
     
     def __getattr__(self, name):
@@ -301,16 +610,71 @@ def dot(x1, x2):
         return _dot(x1, x2)
 
 
-def broadcast(f):
+def broadcast(f, ufunc=None):
+    """
+    Apply `f` elementwise to the broadcast `args`. If all of them are numeric
+    arrays and the ufunc equivalent to `f` is given, it computes the result
+    at once, in the dtype given by numpy; otherwise `f` is applied to each
+    group of elements and the results are collected in an array.
+    """
     @wraps(f)
     def wrapped(*args, **kwds):
-        bc = np.broadcast(*args)
-        ret = np.empty(bc.shape)
-        ret.flat = [f(*args) for args in bc]
-        return ret
+        if ufunc is not None:
+            try:
+                arrs = [exact_array(a) for a in args]
+                if all(a is not None and a.dtype.kind in 'iufc'
+                       for a in arrs) and int_safe(ufunc, arrs):
+                    with np.errstate(divide='raise', over='raise',
+                                     invalid='raise'):
+                        ret = ufunc(*arrs)
+                    return array_value(ret)
+            except (ValueError, ArithmeticError):
+                pass  # let `f` handle it
+        arrs = [np.asarray(a, dtype=object) if exact_array(a) is None else
+                np.asarray(a).astype(object) for a in args]  # python scalars
+        bc = np.broadcast(*arrs)
+        results = [f(*args) for args in bc]
+        try:
+            ret = exact_array(results)
+        except ValueError:  # ragged results
+            ret = None
+        if ret is None or ret.shape != bc.shape:
+            # exact ints beyond int64, or the results are not all scalars
+            ret = np.empty(bc.shape, dtype=object)
+            ret.flat = results
+        return array_value(ret)
     wrapped.__name__ = '<broadcast: %s>' % repr(f)
     return wrapped
 
+def exact_array(a):
+    """`a` as an ndarray, or None if numpy would turn some of its python ints
+    out of the int64 range into floats."""
+    arr = np.asarray(a)
+    if arr.dtype.kind in 'ufc' and not isinstance(a, np.ndarray):
+        for x in np.asarray(a, dtype=object).flat:
+            if isinstance(x, int) and not -1 << 63 <= x < 1 << 63:
+                return None
+    return arr
+
+def int_safe(ufunc, arrs):
+    "Whether `ufunc` on `arrs` cannot overflow if they are integer arrays."
+    kinds = {a.dtype.kind for a in arrs}
+    if not kinds <= set('iu'):
+        return True
+    elif len(kinds) > 1:  # int64 with uint64 gives float64
+        return False
+    bound = 1 << 62
+    m = [max(-int(a.min()), int(a.max())) if a.size else 0 for a in arrs]
+    if ufunc is np.add or ufunc is np.subtract:
+        return sum(m) < bound
+    elif ufunc is np.multiply:
+        return math.prod(m) < bound
+    elif ufunc is np.power:
+        return arrs[1].min(initial=0) >= 0 and \
+            m[1] * math.log2(m[0] + 1) < 62
+    else:
+        return max(m) < bound
+
 Function.broadcast = broadcast
 
 
@@ -327,6 +691,11 @@ def unpack(lst):
 
 
 def index(lst, idx):
+    if isinstance(lst, np.ndarray):
+        i = np_index(idx, lst.shape)
+        if i is not None:
+            return lst[i]
+        
     def ind(lst, i):
         if type(i) is int:
             if i == 0:
@@ -355,6 +724,31 @@ def index(lst, idx):
         items = ind(lst, id0)
         return index(items, idx[1:])
     
+def np_index(idx, shape):
+    """
+    Convert `idx` of (.) to the index of an ndarray of `shape`, or None if
+    it is not made of integers and ranges within the shape.
+    """
+    if type(idx) is not tuple or not idx:  # () is an empty range
+        idx = idx,
+    if len(idx) > len(shape):
+        return None
+    ind = []
+    for i, n in zip(idx, shape):
+        if isinstance(i, Integral) and 0 < abs(i) <= n:
+            ind.append(i - 1 if i > 0 else i)
+        elif type(i) is tuple and not i:  # select nothing, as () would select everything
+            ind.append(slice(0, 0))
+        elif isinstance(i, Range) and Is(Integral)(i.first, i.last, i.step):
+            first, last = (k + n + 1 if k < 0 else k for k in (i.first, i.last))
+            r = range(first - 1, last - 1 + i.step, i.step)
+            if not (r and 0 <= min(r) and max(r) < n):
+                return None
+            ind.append(slice(r.start, r.stop if r.stop >= 0 else None, r.step))
+        else:
+            return None
+    return tuple(ind)
+
 def get_attr(obj, attr):
     if isinstance(attr, Attr):
         attr = attr.name
@@ -411,6 +805,16 @@ def findall(cond, lst):
     else:
         return [i for i, x in enumerate(lst) if eq(x, cond)]
 
+def first(cond, lst):
+    "The first item in `lst` satisfying `cond`."
+    for x in lst:
+        if cond(x): return x
+    raise ValueError('no item satisfies the condition')
+
+def next_(it):
+    "The next item of an iterator, or the first item of a list."
+    return next(it if isinstance(it, Iterator) else iter(it))
+
 
 def range_(x, y):
     if isinstance(x, Range):
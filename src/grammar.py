@@ -189,12 +189,159 @@ def post_process(grammar, macros):
         grammar[obj] = proc_tree(tree)
 
 
+def generate_parser(grammar):
+    """
+    Generate the source of a module specializing CalcParser to the grammar.
+    Each rule becomes a function of the parser and an input position, doing
+    exactly what `Parser.parse_tree` does when interpreting the rule, with
+    the regexes, the atoms and the alternations inlined.
+    """
+    regexes = {}
+    functions = []
+    
+    def regex(pattern):
+        if pattern not in regexes:
+            regexes[pattern] = '_re%d' % len(regexes)
+        return regexes[pattern]
+    
+    def atom(node, pos, tr, rem, at_end=True, skipped=None):
+        """Statements setting `tr` and `rem` to the result of parsing the atom.
+        `at_end` tells whether `pos` may be at the end of the input and
+        `skipped` names a variable holding the position after whitespaces."""
+        tag, arg = node[0], node[1]
+        if skipped:
+            code, q = [], skipped
+        else:
+            code, q = [f'q = {pos} if self.catstr else skip[{pos}]'], 'q'
+        if tag == 'RE':
+            return code + [f'm = {regex(arg)}(input, {q})',
+                           'if m is None or m[0] in keywords:',
+                           f'    {tr} = {rem} = None',
+                           'else:',
+                           f'    {tr}, {rem} = m[0].strip(), m.end()']
+        if tag in ('OBJ', 'PAR'):
+            code = [f'{tr}, {rem} = self.parse_tag({arg!r}, {pos})']
+        elif not arg:
+            code = [f'{tr} = {rem} = None']
+        else:
+            if tag == 'STR':
+                match = f'{arg.strip()!r}'
+                test = f' and {arg!r} not in keywords'
+            else:  # MARK
+                match, test = '[]', ''
+            code += [f'if input.startswith({arg!r}, {q}){test}:',
+                     f'    {tr}, {rem} = {match}, {q} + {len(arg)}',
+                     f'else:',
+                     f'    {tr} = {rem} = None']
+        if at_end:
+            code = [f'if {pos} == n:', f'    {tr} = {rem} = None',
+                    'else:'] + indent(code)
+        return code
+    
+    def child(node, pos, tr, rem, prefix, at_end=True, skipped=None):
+        if node[0] in ('EXP', 'ALT', 'ITEMS', 'VARS', 'ITEM_OP'):
+            return [f'{tr}, {rem} = {function(node, prefix)}(self, {pos})']
+        else:
+            return atom(node, pos, tr, rem, at_end, skipped)
+        
+    def indent(code, n=1):
+        return ['    ' * n + line for line in code]
+    
+    def function(node, prefix, name=None):
+        kind = node[0]
+        if name is None:
+            name = '_%s_%d' % (prefix, len(functions))
+            functions.append(None)
+        
+        if kind == 'EXP':
+            # skip the whitespaces only once for all the alternatives
+            body = ['if pos == n: return failed']
+            if any(alt[0] in ('RE', 'STR', 'MARK') for alt in node[1:]):
+                body += ['q = pos if self.catstr else skip[pos]']
+            for alt in node[1:]:
+                body += child(alt, 'pos', 'tr', 'rem', prefix,
+                              at_end=False, skipped='q')
+                body += ['if rem is not None: return tr, rem']
+            body += ['return failed']
+        elif kind in ('ALT', 'ITEMS', 'VARS'):
+            body = ['if pos == n: return failed']
+            for item in node[1:]:
+                if item[0] in ('STR', 'MARK'):
+                    body += [f'if not self.occurs({item[1]!r}, pos): return failed']
+            body += ['seq, rem = [], pos']
+            for i, item in enumerate(node[1:]):
+                body += child(item, 'rem', 'tr', 'rem', prefix, at_end=i > 0)
+                body += ['if tr is None: return failed',
+                         'self.add_to_seq(seq, tr)']
+            body += ['if len(seq) == 1: seq = seq[0]',
+                     'return seq, rem']
+        elif kind == 'ITEM_OP':
+            item, (_, op) = node[1:]
+            collect = ['if _rem is not None:',
+                       '    if tr:',
+                       '        if isinstance(tr, list) and isinstance(tr[0], (list, SyntaxTree)):',
+                       '            seq.extend(tr)',
+                       '        else:',
+                       '            seq.append(tr)',
+                       '    rem = _rem',
+                       '    rep += 1']
+            step = child(item, 'rem', 'tr', '_rem', prefix) + collect
+            body = ['seq, rem, rep = [], pos, 0']
+            if op in '+*':
+                body += ['while True:'] + indent(step) + \
+                    indent(['if _rem is None: break'])
+            else:
+                body += step
+            if op in '+/-':
+                body += ['if rep == 0: return failed']
+            if op == '!':
+                body += ['if rep: return failed',
+                         'return [], pos']
+            if op == '-':
+                body += ['seq = []']
+            body += ['if seq: seq = Merge(seq)',
+                     'return seq, rem']
+        else:
+            body = atom(node, 'pos', 'tr', 'rem') + ['return tr, rem']
+            
+        header = ['input = self.input', 'n = len(input)']
+        if any('keywords' in line for line in body):
+            header.append('keywords = self.keywords')
+        if any('skip[' in line for line in body):
+            header.append('skip = self.skip')
+        source = '\n'.join([f'def {name}(self, pos):'] + indent(header + body))
+        if name[0] == '_':
+            functions[int(name.rsplit('_', 1)[1])] = source
+        else:
+            functions.append(source)
+        return name
+    
+    rules = {}
+    for tag, body in grammar.items():
+        if tag == ' ': continue
+        rules[tag] = function(body, tag.strip('_'), 'rule_' + tag)
+        
+    lines = ['# generated by grammar.py from grammar.txt; do not edit',
+             '# Merge and SyntaxTree are provided by the loader in parse.py',
+             'import re', '', '',
+             'failed = None, None']
+    lines += ['%s = re.compile(%r).match' % (name, pattern)
+              for pattern, name in regexes.items()]
+    lines += ['', ''] + ['\n\n'.join(functions)]
+    lines += ['', '', 'rules = {']
+    lines += ['    %r: %s,' % item for item in rules.items()]
+    lines += ['}', '']
+    return '\n'.join(lines)
+
+
 grammar = calc_grammar(Grammar)
 semantics = calc_grammar(Semantics)
 del semantics[' ']
+rules = generate_parser(grammar)
 
 json.dump(grammar, open('utils/grammar.json', 'w', encoding='utf8'), indent=2)
 json.dump(semantics, open('utils/semantics.json', 'w'), indent=2)
+open('utils/grammar_rules.py', 'w', encoding='utf8').write(rules)
 
 
 if __name__ == "__main__":
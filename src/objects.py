@@ -1,4 +1,6 @@
 import re
+import numpy as np
+from collections.abc import Iterator
 from sympy import Symbol
 from utils.debug import log, trace
 from utils.funcs import *
@@ -15,30 +17,32 @@ class stack(list):
         except: return None
         
         
-class SyntaxTree(list):
+class SyntaxTree(tuple):
+    """
+    An immutable syntax tree; the nested lists in `tree` are converted to
+    subtrees. Rules that transform a tree build a new one (see `rebuild`),
+    so a tree can be shared and evaluated any number of times.
+    """
+    __slots__ = ()
     tag_pattern = re.compile('[A-Z_:]+')
     
-    def __new__(cls, tree=None):
+    def __new__(cls, tree):
         if isinstance(tree, cls):
-            return tree
-        else:
-            return list.__new__(cls)
-
-    def __init__(self, tree):
-        if isinstance(tree, SyntaxTree):
-            return  # the same object
+            return tree  # the same object
         
         assert type(tree) in [list, tuple]
         assert tree and type(tree[0]) is str
-        assert self.tag_pattern.match(tree[0])
+        assert cls.tag_pattern.match(tree[0])
         
-        self[:] = [tree[0]]
-        for i, t in enumerate(tree):
-            if i == 0: continue
-            self.append(SyntaxTree(t) if type(t) is list else t)
+        return super().__new__(cls, [SyntaxTree(t) if type(t) is list else t
+                                     for t in tree])
     
     @property
     def tag(self): return self[0]
+    
+    def rebuild(self, items):
+        "Return a tree with the same tag whose subtrees are `items` as they are."
+        return tuple.__new__(SyntaxTree, (self[0], *items))
         
     def __repr__(self):
         return '%s[%s]' % (self.tag, ', '.join(map(str, self[1:])))
@@ -52,8 +56,10 @@ def tree_tag(obj):
 
 
 class Function:
-    broadcast = lambda f: NotImplemented
-    proc_in = lambda x: NotImplemented
+    broadcast = lambda f, ufunc: NotImplemented
+    ufunc = None  # the numpy ufunc used in broadcasting
+    lazy = False  # whether lazy lists are passed to it without realization
+    proc_in = lambda x, lazy: NotImplemented
     proc_out = lambda y: NotImplemented
 
     def __init__(self, func):
@@ -66,7 +72,7 @@ class Function:
         return self.__name__
     
     def func(self, *args):
-        args = Function.proc_in(args)
+        args = Function.proc_in(args, self.lazy)
         ret = self._func(*args)
         return Function.proc_out(ret)
     
@@ -76,7 +82,7 @@ class Function:
         except TypeError:
             if not self.broadcast: raise
         try:
-            return Function.broadcast(self.func)(*args)
+            return Function.broadcast(self.func, self.ufunc)(*args)
         except ValueError:
             return deepmap(self.func, args)
     
@@ -115,6 +121,9 @@ class Op(Function):
     def __repr__(self):
         return f"{self.type}({self.symbol}, {self.priority})"
     
+    def __reduce__(self):
+        return find_op, (self.type, self.symbol)
+    
     def __eq__(self, other):
         return isinstance(other, Op) and self.__dict__ == other.__dict__
 
@@ -122,12 +131,22 @@ class Op(Function):
         return self.symbol
 
 
+def find_op(type, symbol):
+    "The operator of the type denoted by the symbol."
+    op = Op(symbol)
+    return op if op.type == type else op.amb
+
+
 class Builtin(Function):
     def __init__(self, func, name):
         super().__init__(func)
         self.__name__ = name
         
     def __call__(self, val):
+        if isinstance(val, LazyList) and not self.lazy:
+            val = val.realize()
+        if isinstance(val, (np.ndarray, Iterator, LazyList, Stream)):  # not unpacked
+            return super().__call__(val)
         try:
             return super().__call__(*val)
         except:
@@ -139,18 +158,22 @@ deparse = lambda tree: NotImplemented
 
 class Map(Function):
     bind = lambda form, val, env: NotImplemented
-    eval = lambda tree, env, inplace: NotImplemented
+    eval = lambda tree, env: NotImplemented
+    compile = lambda tree: NotImplemented
 
     def __init__(self, tree, env):
         _, form, body = tree
         if tree_tag(form) != 'FORM':  # ensure it is evaluated as a form
-            form = ['FORM', form]
+            form = SyntaxTree(['FORM', form])
             
         self.form = Map.eval(form, env)
         self.body = Map.eval(body, None)
+        self._code = Map.compile(self.body)
         self.env = env
         self._pars = form[-1]
-        self._memo = {} if self.check_local() else None
+        self._memo = None
+        self._self_name = None  # the name by which it calls itself
+        self.set_memo(self.check_local())
         self.__name__ = None
         self.__doc__ = None
         
@@ -162,19 +185,55 @@ class Map(Function):
         
     @trace
     def _func(self, val):
-        try: return self._memo[val]
-        except: pass
+        memo = self._memo
+        if self._self_name is not None and \
+                dict.get(self.env, self._self_name) is not self:
+            self._self_name = None  # the name is bound to something else now
+            self.set_memo(self.check_local())
+            memo = self._memo
+        if memo is not None:
+            try:
+                key = memo_key(val)
+                return memo.lookup(key)
+            except KeyError:
+                pass
+            except TypeError:  # not hashable
+                memo = None
         
         local = self.env.child()
         Map.bind(self.form, val, local)
-        result = Map.eval(self.body, local, inplace=False)
+        result = self._code(local)
             
-        try: self._memo[val] = result
-        except: pass
+        if memo is not None:
+            memo.store(key, result)
         return result
     
-    def check_local(self):
-        "Check whether the map depends on outside variables."
+    def set_memo(self, on):
+        "Turn on or off the memo of the results of the map."
+        if not on:
+            self._memo = None
+        elif self._memo is None:
+            self._memo = MemoTable(config.map_memo_size)
+            
+    def memo_stats(self):
+        "The statistics of the memo with its hit rate, or None if it is off."
+        if self._memo is None: return None
+        stats = self._memo.stats()
+        calls = stats['hits'] + stats['misses']
+        stats['rate'] = stats['hits'] / calls if calls else 0
+        return stats
+    
+    def __getstate__(self):  # the compiled code is not picklable
+        state = self.__dict__.copy()
+        del state['_code']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._code = Map.compile(self.body)
+    
+    def check_local(self, names=()):
+        "Check whether the map depends on outside variables other than `names`."
         def collect_vars(tr):
             if is_tree(tr):
                 if tr.tag == 'NAME':
@@ -184,7 +243,7 @@ class Map(Function):
                         collect_vars(t)
         vars = set()
         collect_vars(self.body)
-        return vars.issubset(self.form.vars)
+        return vars.issubset(self.form.vars.union(names))
     
     def __str__(self):
         return '%s → %s' % (self._form_repr, self._body_repr)
@@ -208,6 +267,19 @@ class Map(Function):
         return path
     
     
+def memo_key(val):
+    "A hashable key of the argument of a map; raise TypeError if there is none."
+    if type(val) in (tuple, list):
+        return tuple(map(memo_key, val))
+    elif isinstance(val, Args):
+        return (Args, memo_key(val.val),
+                frozenset((k, memo_key(v)) for k, v in val.items()))
+    elif isinstance(val, (Env, np.ndarray, LazyList)):
+        raise TypeError('mutable argument')
+    hash(val)
+    return val
+    
+
 class Form(list):
     def __init__(self, form, vars):
         self[:] = form
@@ -229,6 +301,7 @@ class Form(list):
 
 class Env(dict):
     default_name = '(env)'
+    roots = {}  # envs pickled as references by their names
     
     def __init__(self, val=None, parent=None, name=None,
                  binds=None, hide_parent=True):
@@ -288,6 +361,11 @@ class Env(dict):
     def __bool__(self):
         return True
     
+    def __reduce_ex__(self, protocol):
+        if Env.roots.get(self.name) is self:
+            return Env.roots.get, (self.name,)
+        return super().__reduce_ex__(protocol)
+    
     
 class Args(Env):
     
@@ -379,6 +457,9 @@ class Range:
         else:
             return obj
 
+    def __getnewargs__(self):
+        return self.first, self.last, self._step, self.second
+
     def __repr__(self):
         items = [self.first, self.last, self.step]
         if self.step in (1, -1): items.pop()
@@ -407,6 +488,77 @@ class Range:
                    for a in ['first', 'last', 'step'])
 
 
+class LazyList:
+    "A list whose items are computed by an iterator only when they are needed."
+    
+    def __init__(self, it):
+        self._it = iter(it)
+        self._items = []
+        self._tuple = None
+        
+    def _fetch(self):
+        "Compute the next item; return whether there is one."
+        if self._it is None: return False
+        try:
+            self._items.append(next(self._it))
+            return True
+        except StopIteration:
+            self._it = None
+            return False
+        
+    def __iter__(self):
+        i = 0
+        while i < len(self._items) or self._fetch():
+            yield self._items[i]
+            i += 1
+            
+    def __bool__(self):
+        return bool(self._items) or self._fetch()
+    
+    def __len__(self):
+        return len(self.realize())
+    
+    def __getitem__(self, i):
+        return self.realize()[i]
+    
+    def realize(self):
+        "All the items in a tuple, in which the lazy lists are also realized."
+        if self._tuple is None:
+            while self._fetch(): pass
+            self._tuple = tuple(map(realize, self._items))
+        return self._tuple
+    
+    def __repr__(self):
+        return repr(self.realize())
+    
+
+class Stream:
+    """
+    A lazy sequence whose items are generated anew by `gen(*args)` each time
+    it is iterated, so that it is never used up nor kept in memory.
+    """
+    
+    def __init__(self, gen, *args, name=None):
+        self._gen, self._args = gen, args
+        self._name = name or gen.__name__
+        
+    def __iter__(self):
+        return iter(self._gen(*self._args))
+    
+    def __repr__(self):
+        return self._name
+    
+
+def realize(val):
+    "Realize the lazy lists in the value."
+    if isinstance(val, LazyList):
+        return val.realize()
+    elif type(val) is tuple and any(isinstance(x, (tuple, LazyList)) for x in val):
+        return tuple(map(realize, val))
+    else:
+        return val
+
+
 if __name__ == "__main__":
     # interact()
     import doctest
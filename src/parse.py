@@ -1,19 +1,62 @@
-import re, json, ast
+import re, json, ast, inspect
+import pickle, hashlib, itertools
+from os.path import commonprefix
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 import config
-from builtin import operators
+from builtin import operators, op_symbols
 from objects import Form, Op, SyntaxTree, tree_tag, is_tree
 from utils.funcs import *
 from utils.debug import trace, interact, check, check_record, pprint
 
 
-try:
-    assert not config.debug
-    with open('utils/grammar.json', encoding='utf8') as f:
-        grammar = json.load(f)
-    with open('utils/semantics.json') as f:
-        semantics = json.load(f)
-except:
-    from grammar import grammar, semantics
+grammar_cache = 'utils/grammar.pkl'
+grammar_cache_version = 2  # increase it when the format of the cache changes
+rules_file = 'utils/grammar_rules.py'  # written by 'grammar.py'
+
+
+def grammar_digest():
+    "Hash the sources the compiled grammar is generated from."
+    h = hashlib.sha1(b'%d' % grammar_cache_version)
+    for path in ['grammar.txt', 'semantics.txt', 'grammar.py']:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    h.update(inspect.getsource(compile_grammar).encode())
+    h.update(repr(sorted(op_symbols)).encode())
+    h.update(config.whitespace.encode())
+    return h.hexdigest()
+
+
+def load_grammar():
+    """Load the compiled grammar, the semantics and the source of the generated
+    parsing rules from the cache; regenerate them with 'grammar.py' and
+    rewrite the cache only if it is stale."""
+    digest = grammar_digest()
+    try:
+        with open(grammar_cache, 'rb') as f:
+            cache = pickle.load(f)
+        if cache['digest'] == digest:
+            return cache['grammar'], cache['semantics'], cache['rules']
+    except Exception:  # missing, stale or written by another version
+        pass
+    
+    from grammar import grammar, semantics, rules
+    grammar = compile_grammar(grammar)
+    cache = {'digest': digest, 'grammar': grammar,
+             'semantics': semantics, 'rules': rules}
+    try:
+        with open(grammar_cache, 'wb') as f:
+            pickle.dump(cache, f)
+    except OSError:
+        pass  # the cache is optional
+    return grammar, semantics, rules
+
+
+def load_rules(source):
+    "Execute the generated source of the parsing rules and return them by tag."
+    ns = {'Merge': Merge, 'SyntaxTree': SyntaxTree}
+    exec(compile(source, rules_file, 'exec'), ns)
+    return ns['rules']
 
     
 def compile_grammar(grammar):
@@ -30,46 +73,74 @@ def compile_grammar(grammar):
     return grammar
 
 
+class Merge(list):
+    "A sequence of subtrees to be merged into the sequence it is added to."
+    __slots__ = ()
+
+
 class Parser:
+    """
+    A packrat parser working on an immutable input buffer. Instead of passing
+    the remaining text around, the parsing methods take and return integer
+    positions in `self.input`; the results of `parse_tag` are memoized by
+    (tag, position) in a MemoTable that is emptied after each call of `parse`
+    and bounded by `config.memo_size`.
+    """
     failed = None, None
     grammar = None
     held_tags = set()
     
     def __init__(self):
-        self.to_merge = []
+        self.input = ''
+        self.memo = MemoTable(config.memo_size)
+        self.last_seen = {}
         
-    def parse_tree(self, rule, text):
+    def parse(self, tag, input):
+        "Parse the whole input as `tag` and return the tree and the unparsed rest."
+        self.input = input
+        self.memo.maxsize = config.memo_size
+        try:
+            tree, pos = self.parse_tag(tag, 0)
+        finally:
+            self.memo.clear()
+            self.last_seen.clear()
+        if pos is None:
+            return self.failed
+        return tree, input[pos:]
+        
+    def parse_tree(self, rule, pos):
         tag, body = rule[0], rule[1:]
 
-        if not text and tag not in ('ITEM_OP', 'RE'):
+        if pos == len(self.input) and tag not in ('ITEM_OP', 'RE'):
             return self.failed
 
         if tag == 'EXP':
-            return self.parse_alts(body, text)
+            return self.parse_alts(body, pos)
         elif tag in ('ALT', 'ITEMS', 'VARS'):
-            return self.parse_seq(body, text)
+            return self.parse_seq(body, pos)
         elif tag in ('OBJ', 'PAR'):
-            return self.parse_tag(body[0], text)
+            return self.parse_tag(body[0], pos)
         elif tag == 'ITEM_OP':
             item, [_, op] = body
-            return self.parse_op(item, op, text)
+            return self.parse_op(item, op, pos)
         else:
-            return self.parse_atom(tag, body[0], text)
+            return self.parse_atom(tag, body[0], pos)
         
-    def parse_alts(self, alts, text):
+    def parse_alts(self, alts, pos):
         for alt in alts:
-            tree, rem = self.parse_tree(alt, text)
+            tree, rem = self.parse_tree(alt, pos)
             if rem is not None:
                 return tree, rem
         return self.failed
 
-    def parse_seq(self, seq, text):
-        tree, rem = [], text
+    def parse_seq(self, seq, pos):
+        tree, rem = [], pos
 
         # precheck if the keywords are in the text
         for item in seq:
-            if type(text) is not str: break
-            if item[0] in ['STR', 'MARK'] and item[1] not in text:
+            if type(self.input) is not str: break
+            if item[0] in ['STR', 'MARK'] and \
+                not self.occurs(item[1], pos):
                 return self.failed
             
         for item in seq:
@@ -80,31 +151,36 @@ class Parser:
         if len(tree) == 1: tree = tree[0]
         return tree, rem
     
+    def occurs(self, s, pos):
+        "Check whether `s` occurs in the input after `pos`."
+        try:
+            last = self.last_seen[s]
+        except KeyError:
+            last = self.last_seen[s] = self.input.rfind(s)
+        return last >= pos
+    
     def add_to_seq(self, seq, tr):
         if not tr: return
-        elif tr in self.to_merge:
-            self.to_merge.remove(tr)
+        elif type(tr) is Merge:
             for t in tr: self.add_to_seq(seq, t)
         else:
             seq.append(tr)
     
-    def parse_atom(self, tag, pattern, text):
+    def parse_atom(self, tag, pattern, pos):
         if tag == 'RE':
-            m = pattern.match(text)
+            m = pattern.match(self.input, pos)
             if not m: return self.failed
-            else: return m[0], text[m.end():]
+            else: return m[0], m.end()
         else:  # STR or MARK
-            try:
-                pre, rem = text.split(pattern, 1)
-                assert not pre
+            if pattern and self.input.startswith(pattern, pos):
                 mat = pattern if tag == 'STR' else []
-                return mat, rem
-            except:
+                return mat, pos + len(pattern)
+            else:
                 return self.failed
            
-    # Caution: must not add @memo decorator!
-    def parse_op(self, item, op, text):
-        seq, rem = [], text
+    # Caution: must not add @packrat decorator!
+    def parse_op(self, item, op, pos):
+        seq, rem = [], pos
         rep, maxrep = 0, (-1 if op in '+*' else 1)
 
         while maxrep < 0 or rep < maxrep:
@@ -112,7 +188,7 @@ class Parser:
             if _rem is None: break
             if tr:
                 if isinstance(tr, list) and \
-                    isinstance(tr[0], list):
+                    isinstance(tr[0], (list, SyntaxTree)):
                         seq.extend(tr)
                 else:
                     seq.append(tr)
@@ -123,21 +199,21 @@ class Parser:
             return self.failed
         elif op == '!':
             if rep: return self.failed
-            else: return [], text 
+            else: return [], pos 
         elif op == '-':
             seq = []
 
-        if seq: self.to_merge.append(seq)
+        if seq: seq = Merge(seq)
         return seq, rem
     
     # @trace
-    @memo
-    def parse_tag(self, tag, text):
+    @packrat
+    def parse_tag(self, tag, pos):
         alttag = None
         if ':' in tag:  # ALTTAG:TAG
             alttag, tag = tag.split(':')
 
-        tree, rem = self.parse_tree(self.grammar[tag], text)
+        tree, rem = self.parse_rule(tag, pos)
         if tree is None: return self.failed
         
         if alttag: tag = alttag
@@ -148,10 +224,13 @@ class Parser:
         else:
             return tree, rem
 
+    def parse_rule(self, tag, pos):
+        return self.parse_tree(self.grammar[tag], pos)
+
     def process_tag(self, tag, tree):
         if not tree:
             return [tag]
-        elif isinstance(tree, list):
+        elif isinstance(tree, (list, SyntaxTree)):
             if tag in self.held_tags:
                 if is_tree(tree):
                     tree = [tag, tree]
@@ -161,7 +240,7 @@ class Parser:
                 if len(tree) == 1:
                     tree = tree[0]
                 elif tag[0] == '_':
-                    self.to_merge.append(tree)
+                    tree = Merge(tree)
                 else:
                     tree = [tag] + tree
             return tree
@@ -169,15 +248,75 @@ class Parser:
             return [tag, tree]
 
 
+Token = namedtuple('Token', 'kind text start end')
+
+
+class Lexer:
+    """
+    Split a line into tokens in a single pass of one regex. Every character
+    other than whitespaces belongs to some token, so the tokens also tell the
+    parser where the next non-whitespace character is without rescanning.
+    
+    >>> lexer = Lexer({'+', '<=', 'and'}, {'if'})
+    >>> [(t.kind, t.text) for t in lexer.tokenize('x<=1.5e3 if f("a")+ 2')]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('NAME', 'x'), ('OP', '<='), ('NUM', '1.5e3'), ('KEYWORD', 'if'),
+     ('NAME', 'f'), ('BRACKET', '('), ('STR', '"a"'), ('BRACKET', ')'),
+     ('OP', '+'), ('NUM', '2')]
+    >>> Lexer.skip_table(lexer.tokenize(' a  b '), 6)
+    [1, 1, 4, 4, 4, 6, 6]
+    """
+    def __init__(self, ops, keywords):
+        ops = sorted((op for op in ops if op and not op.isalpha()),
+                     key=len, reverse=True)
+        patterns = [
+            ('SPACE',   r'\s+'),
+            ('NUM',     r'0b[01]+|0x[0-9a-fA-F]+|\d+(\.\d+)?([eE]-?\d+)?'),
+            ('STR',     r'[a-z]?"(?:[^"\\]|\\.)*"'),
+            ('NAME',    r'[^\W\d]\w*'),
+            ('OP',      '|'.join(map(re.escape, ops))),
+            ('BRACKET', r'[()\[\]{}⟨⟩]'),
+            ('MARK',    r'\S'),
+        ]
+        self.pattern = re.compile('|'.join('(?P<%s>%s)' % p for p in patterns))
+        self.keywords = keywords
+        
+    def tokenize(self, text, pos=0):
+        tokens = []
+        for m in self.pattern.finditer(text, pos):
+            kind = m.lastgroup
+            if kind == 'SPACE': continue
+            if kind == 'NAME' and m[0] in self.keywords:
+                kind = 'KEYWORD'
+            tokens.append(Token(kind, m[0], m.start(), m.end()))
+        return tokens
+    
+    @staticmethod
+    def skip_table(tokens, length, start=0):
+        """Map each position from `start` on to that of the first non-whitespace
+        from it on; `tokens` are those beginning after `start`."""
+        skip = list(range(start, length + 1))
+        end = start
+        for tok in tokens:
+            skip[end-start:tok.start-start] = [tok.start] * (tok.start - end)
+            end = tok.end
+        skip[end-start:length-start] = [length] * (length - end)
+        return skip
+
+
+grammar, semantics, rules = load_grammar()
+
+
 class CalcParser(Parser):
-    grammar = compile_grammar(grammar)
+    grammar = grammar
+    rules = load_rules(rules)  # set to None to interpret the grammar instead
 
     held_tags = {
         'DIR', 'DEL', 'QUOTE', 'UNQUOTE', 'INFO', 'ENV',
         'LIST', 'ARRAY', 'FORM', 'NS', 'UNPACK'
     }
 
-    keywords = {'dir', 'load', 'config', 'import', 'del',
+    keywords = {'dir', 'load', 'config', 'import', 'mmap', 'del',
                 'info', 'exit', 'if', 'and', 'or'}
 
     synonyms = str.maketrans({
@@ -189,7 +328,14 @@ class CalcParser(Parser):
     def __init__(self):
         super().__init__()
         self.catstr = None
-        self.whitespace = self.grammar[' ']
+        self.lexer = Lexer(op_symbols, self.keywords)
+        self.tokens = []
+        self.skip = [0]
+        
+    def parse(self, tag, input):
+        self.tokens = self.lexer.tokenize(input)
+        self.skip = Lexer.skip_table(self.tokens, len(input))
+        return super().parse(tag, input)
         
     def add_to_seq(self, seq, tr):
         if not tr: return
@@ -200,55 +346,229 @@ class CalcParser(Parser):
         else:
             super().add_to_seq(seq, tr)
         
-    def lstrip(self, text):
-        if self.catstr: return text
-        sp = re.match(self.whitespace, text)
-        return text[sp.end():]
+    def parse_rule(self, tag, pos):
+        if self.rules is None:
+            return super().parse_rule(tag, pos)
+        return self.rules[tag](self, pos)
+        
+    def lstrip(self, pos):
+        "Skip the whitespaces starting from `pos`."
+        if self.catstr: return pos
+        return self.skip[pos]
         
-    def parse_atom(self, tag, pattern, text):
-        text = self.lstrip(text)
-        atom, rem = super().parse_atom(tag, pattern, text)
+    def parse_atom(self, tag, pattern, pos):
+        pos = self.lstrip(pos)
+        atom, rem = super().parse_atom(tag, pattern, pos)
         if type(atom) is str and atom in self.keywords:
             return self.failed
         else:
             if atom: atom = atom.strip()
             return atom, rem
         
-    def parse_op(self, item, op, text):
-        tree, rem = super().parse_op(item, op, text)
+    def parse_op(self, item, op, pos):
+        tree, rem = super().parse_op(item, op, pos)
         if tree and op == '/':
             assert type(tree) is str
             self.no_space.append(tree)
         return tree, rem
     
-    def parse_tag(self, tag, text):
+    def parse_tag(self, tag, pos):
         # prechecks to speed up parsing
-        if not text and tag != 'LINE':
+        if pos == len(self.input) and tag != 'LINE':
             return self.failed
         if tag == 'OP':
-            text = self.lstrip(text)
+            pos = self.lstrip(pos)
             
-        tree, rem = super().parse_tag(tag, text)
+        tree, rem = super().parse_tag(tag, pos)
         return tree, rem
     
 
+class ReachTable(MemoTable):
+    """
+    The memo table of an IncrementalParser. Besides the results, it records
+    for each entry the furthest position examined while computing it.
+    """
+    def __init__(self, parser):
+        super().__init__()
+        self.parser = parser
+        self.reaches = {}
+        self.outer = []  # reaches of the computations in progress
+        
+    def lookup(self, key):
+        try:
+            value = super().lookup(key)
+        except KeyError:
+            self.outer.append(self.parser.reach)
+            self.parser.reach = key[1]
+            raise
+        self.parser.see(self.reaches[key])
+        return value
+    
+    def store(self, key, value):
+        self.reaches[key] = reach = self.parser.reach
+        self.parser.reach = max(self.outer.pop(), reach)
+        return super().store(key, value)
+    
+    def invalidate(self, pos):
+        "Remove the entries that examined the input from `pos` on."
+        for key in [k for k, r in self.reaches.items() if r >= pos]:
+            del self[key], self.reaches[key]
+
+
+class IncrementalParser(CalcParser):
+    """
+    A CalcParser for an input under editing, like the line typed in the REPL.
+    It keeps its packrat table, tokens and bracket states between parses; when
+    the input changes from some position on, only what depended on the changed
+    part is dropped, so parsing it again only redoes the work from there.
+    
+    The grammar is interpreted to track how far each rule looked ahead. A regex
+    (as well as a token) is assumed to examine at most `lookahead` chars beyond
+    the token it fails in or the end of its match, except for the string
+    literals, which may scan to the end of the input. The trees returned share
+    memoized subtrees with later parses.
+    """
+    rules = None
+    lookahead = 3
+    opening = {')': '(', ']': '[', '}': '{', '⟩': '⟨'}
+    
+    def __init__(self):
+        super().__init__()
+        self.memo = ReachTable(self)
+        self.reach = 0
+        self.starts = []  # start positions of the tokens
+        self.stacks = []  # unclosed brackets after each token
+        
+    def parse(self, tag, input):
+        self.edit(input)
+        self.reach, self.memo.outer = 0, []
+        tree, pos = self.parse_tag(tag, 0)
+        if pos is None:
+            return self.failed
+        return tree, input[pos:]
+    
+    def edit(self, input):
+        "Update the state of the parser after its input is changed to `input`."
+        if input == self.input: return
+        pos = len(commonprefix([self.input, input]))
+        self.memo.invalidate(pos)
+        
+        # lex again from the end of the last token not affected by the edit
+        i = bisect_left([t.end for t in self.tokens], pos - self.lookahead)
+        for k, tok in enumerate(self.tokens[:i]):
+            if tok.text == '"':  # may begin a string literal now
+                i = max(k - 1, 0)
+                break
+        start = self.tokens[i-1].end if i else 0
+        tokens = self.lexer.tokenize(input, start)
+        self.tokens[i:] = tokens
+        self.starts[i:] = [t.start for t in tokens]
+        self.stacks[i:] = []
+        self.skip[start:] = Lexer.skip_table(tokens, len(input), start)
+        self.last_seen.clear()
+        self.input = input
+        
+    def check(self, text):
+        """Parse the edited text; return whether it is a valid line and the
+        positions in it of the unclosed brackets (None if some brackets are
+        mismatched)."""
+        input = text.translate(self.synonyms)
+        tree, rem = self.parse('LINE', input)
+        brackets = self.brackets()
+        if brackets is None:
+            return rem == '', None
+        pos = [tok.start for tok in brackets]
+        if len(input) != len(text):  # map them back to the positions in text
+            ends = list(itertools.accumulate(
+                len(c.translate(self.synonyms)) for c in text))
+            pos = [bisect_right(ends, p) for p in pos]
+        return rem == '', pos
+    
+    def brackets(self):
+        """Return the unclosed bracket tokens, with the quote of an unclosed
+        string, or None if some brackets are mismatched."""
+        stack = self.stacks[-1] if self.stacks else ()
+        if stack is not None: stack = list(stack)
+        for tok in self.tokens[len(self.stacks):]:
+            if stack is None or stack and stack[-1].text == '"':
+                pass  # mismatched, or in an unclosed string
+            elif tok.text == '"':  # a string is not closed
+                stack.append(tok)
+            elif tok.kind == 'BRACKET':
+                if tok.text not in self.opening:
+                    stack.append(tok)
+                elif stack and stack[-1].text == self.opening[tok.text]:
+                    stack.pop()
+                else:
+                    stack = None
+            self.stacks.append(stack if stack is None else tuple(stack))
+        return self.stacks[-1] if self.stacks else ()
+        
+    def see(self, pos):
+        "Record that the input has been examined up to `pos`."
+        if pos > self.reach: self.reach = pos
+        
+    def token_end(self, pos):
+        i = bisect_right(self.starts, pos) - 1
+        return max(pos, self.tokens[i].end if i >= 0 else 0)
+    
+    def parse_tree(self, rule, pos):
+        if pos == len(self.input): self.see(pos)
+        return super().parse_tree(rule, pos)
+        
+    def parse_tag(self, tag, pos):
+        if pos == len(self.input): self.see(pos)
+        return super().parse_tag(tag, pos)
+    
+    def occurs(self, s, pos):
+        if super().occurs(s, pos):
+            self.see(self.last_seen[s] + len(s))
+            return True
+        else:
+            self.see(len(self.input))
+            return False
+        
+    def lstrip(self, pos):
+        pos = super().lstrip(pos)
+        self.see(pos)
+        return pos
+    
+    def parse_atom(self, tag, pattern, pos):
+        atom, rem = super().parse_atom(tag, pattern, pos)
+        pos = self.lstrip(pos)
+        if tag != 'RE':
+            self.see(pos + len(pattern))
+        elif rem is not None:
+            self.see(rem + self.lookahead)
+        elif '"' in self.input[pos:pos+2]:
+            self.see(len(self.input))
+        else:
+            self.see(self.token_end(pos) + self.lookahead)
+        return atom, rem
+
+
 calc_parser = CalcParser()
+parse_cache = MemoTable(config.parse_cache_size)
 
 def calc_parse(text):
+    "Parse a line; the result is cached by the translated text."
     text = text.translate(CalcParser.synonyms)
-    tree, rem = calc_parser.parse_tag('LINE', text)
-    return tree, rem
+    try:
+        return parse_cache.lookup(text)
+    except KeyError:
+        pass
+    return parse_cache.store(text, calc_parser.parse('LINE', text))
 
         
 def deparse(tree):
     "Reconstruct the expression from the syntax tree."
     
     def rec(tr):
-        tag = tree_tag(tr)
+        tag = tr[0] if type(tr) is Form else tree_tag(tr)
         
         if tag is None:
             if type(tr) is tuple:
-                 tr = list(map(rec, tr))
+                return '[%s]' % ', '.join(map(rec, tr))
             else:
                 return str(tr)
         
@@ -2,6 +2,8 @@ import sys, os
 import re
 from .debug import logfile, freeze
 from functools import wraps, partial
+from collections import OrderedDict
+import config
 from my_utils.utils import interact, main
 
 
@@ -49,6 +51,8 @@ def depth(value, key=max, _cache=None):
         
     if not indexable(value):
         return 0
+    elif type(getattr(value, 'ndim', None)) is int:  # an ndarray
+        return value.ndim
     
     if id(value) in _cache:
         return float('inf')
@@ -103,21 +107,75 @@ def haslen(value):
 
 # decorators
 
+class MemoTable(OrderedDict):
+    """
+    A table of computed results that evicts its least recently used entries
+    once it holds more than `maxsize` of them (no limit if `maxsize` is falsy).
+    It counts the hits, misses and evictions over its whole lifetime.
+    
+    >>> t = MemoTable(2)
+    >>> for k in 'abc': _ = t.store(k, k.upper())
+    >>> list(t)
+    ['b', 'c']
+    >>> t.lookup('c')
+    'C'
+    >>> t.stats()
+    {'size': 2, 'hits': 1, 'misses': 0, 'evictions': 1}
+    """
+    def __init__(self, maxsize=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        
+    def lookup(self, key):
+        "Return the result stored for `key`; raise KeyError if there is none."
+        try:
+            value = self[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        if self.maxsize: self.move_to_end(key)
+        return value
+    
+    def store(self, key, value):
+        self[key] = value
+        if self.maxsize:
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+                self.evictions += 1
+        return value
+    
+    def stats(self):
+        return {'size': len(self), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
 def memo(f):
     "Use a table to store computed results of a function."
-    table = {}
+    table = MemoTable(config.memo_size)
     @wraps(f)
-    def _f(*args, retry=1):
+    def _f(*args):
         try:
-            return table[args]
+            return table.lookup(args)
         except KeyError:
-            result = f(*args)
-            table[args] = result
-            return result
+            pass
         except TypeError:
-            # if retry:
-            #     args = freeze(args)
-            #     return _f(*args, retry=0)
-            # else:
             return f(*args)
+        return table.store(args, f(*args))
+    _f.table = table
+    return _f
+
+
+def packrat(f):
+    """Memoize a parsing method of a Parser by its rule and input position.
+    The results are stored in the parser's own MemoTable `self.memo`."""
+    @wraps(f)
+    def _f(self, rule, pos):
+        key = rule, pos
+        try:
+            return self.memo.lookup(key)
+        except KeyError:
+            pass
+        return self.memo.store(key, f(self, rule, pos))
     return _f
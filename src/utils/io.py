@@ -4,6 +4,7 @@ import re
 import msvcrt
 import time
 from .unicode import subst, map_2chars
+from .debug import log
 
 
 getch = msvcrt.getwch
@@ -126,7 +127,8 @@ def read(end='\r\n', indent=0):
     read.index = len(read.history)
     read.history.append(buffer)
     
-    text = ''
+    text = read.pending = ''
+    margins = [indent]  # where each line of the input starts on the screen
     while True:
         end_ch = _read()
         i, j = substart, ins()
@@ -149,7 +151,7 @@ def read(end='\r\n', indent=0):
             
         if end_ch in end:
             line = ''.join(buffer)
-            next_indent = BracketTracker.next_insertion(' '*indent + line)
+            next_indent = next_insertion(' '*indent + line, margins)
             
             if line and line[-1] == '\\':
                 delete()
@@ -161,6 +163,8 @@ def read(end='\r\n', indent=0):
                 write(' ' * indent)
                 text += ''.join(buffer[:ins()])
                 buffer[:] = buffer[ins():]
+                read.pending = text
+                margins.append(indent)
             else:
                 for _ in range(caret):
                     move_cursor('M')  # move to the end of line
@@ -179,6 +183,39 @@ read.index = 0
 read.history = []
 read.keywords = {}
 read.highlight = text_style['bright-blue']
+read.pending = ''       # the completed lines of the current input
+read.on_edit = None     # checks the whole input after each edit
+read.status = None      # the result of the last call of on_edit
+
+
+def check_input():
+    """Check the whole input by read.on_edit, which returns whether it is
+    valid and the positions of its unclosed brackets (None if mismatched).
+    The check is turned off if it fails."""
+    if read.on_edit:
+        try:
+            read.status = read.on_edit(read.pending + ''.join(buffer))
+        except Exception as e:
+            read.on_edit = read.status = None
+            log('input check turned off: %r' % e)
+    return read.status
+
+
+def next_insertion(line, margins):
+    """The indent of the next line of the input, after its last unclosed
+    bracket; `line` is the current line with its indent and `margins` are
+    the indents of the lines."""
+    status = check_input()
+    if status is None:
+        return BracketTracker.next_insertion(line)
+    brackets = status[1]
+    if brackets is None:
+        raise SyntaxError('bad brackets')
+    elif not brackets:
+        return 0
+    text, pos = read.pending + ''.join(buffer), brackets[-1]
+    start = text.rfind('\n', 0, pos) + 1
+    return margins[text.count('\n', 0, pos)] + pos - start + 1
 
 
 def _read():
@@ -234,6 +271,9 @@ def _read():
             auto_sub = False
             
         edited = 1
+        status = check_input()
+        if status and status[1] is None and c in BracketTracker.close_pars:
+            write('\b' + c, style='red')  # show the mismatched bracket
     
     raise IOError("failed to read input")
 